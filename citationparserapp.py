@@ -1,16 +1,19 @@
 import os
 import zipfile
 import shutil
-import tempfile
 import re
 import json
 import requests
 import uuid
+import hashlib
+import time
 import xml.dom.minidom as minidom
+from lxml import etree as ET
 from flask import Flask, render_template, request, jsonify, send_file, session, redirect, url_for
 from werkzeug.utils import secure_filename
 from pathlib import Path
-from datetime import datetime
+from collections import OrderedDict
+from functools import lru_cache
 from urllib.parse import urlparse, unquote
 
 # ============= REMOVED ADVANCED SEARCH IMPORTS (they don't exist) =============
@@ -24,6 +27,7 @@ from urllib.parse import urlparse, unquote
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'production-key-v19-style-preservation'
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_CONTENT_LENGTH', 100 * 1024 * 1024))
 
 # ============= REMOVED ADVANCED SEARCH INITIALIZATION =============
 # These modules don't exist, commenting out
@@ -35,112 +39,174 @@ UPLOAD_FOLDER = 'uploads'
 ALLOWED_EXTENSIONS = {'docx'}
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
+# WordprocessingML namespaces: Transitional, and the one Strict Open XML files use
+W_NAMESPACES = ('{http://schemas.openxmlformats.org/wordprocessingml/2006/main}',
+                '{http://purl.oclc.org/ooxml/wordprocessingml/main}')
+W_ENDNOTE_TAGS = tuple(ns + 'endnote' for ns in W_NAMESPACES)
+
+# Citation patterns, compiled once at import instead of on every call
+# Book (Author. Title. City: Publisher, Year) and journal article patterns in
+# one alternation; the matching branch is reported by match.lastgroup. Field
+# lengths are bounded so a long near-miss (e.g. a run of spaces after the
+# journal name) cannot backtrack quadratically
+_WORK_RE = re.compile(
+    r'(?P<book>(?P<book_author>[^.\n]{1,200})\.\s+(?P<book_title>[^.\n]{1,300})\.\s+'
+    r'(?P<city>[^:\n]{1,80}):\s+(?P<publisher>[^,\n]{1,100}),\s+(?P<year>\d{4}))'
+    r'|(?P<journal>(?P<journal_author>[^.\n]{1,200})\.\s+"(?P<journal_title>[^"\n]{1,300})"\s+'
+    r'(?P<journal_name>[^,\n]{1,100}),?\s+(?:vol\.\s+)?(?P<volume>\d+))'
+)
+_URL_RE = re.compile(r'(https?://[^\s]+|www\.[^\s]+)')
+_ACCESS_DATE_RE = re.compile(r'[Aa]ccessed\s+([^.]+)')
+
+class InvalidDocumentError(ValueError):
+    """An uploaded DOCX that is structurally unusable"""
+
+# Errors that mean the uploaded file is not a readable DOCX, as opposed to a bug
+_DOCUMENT_ERRORS = (zipfile.BadZipFile, ET.XMLSyntaxError, InvalidDocumentError)
+
+# Output docx compression: a fast deflate level, and no deflate at all for
+# images that are already compressed
+_DEFLATE_LEVEL = 1
+_PRECOMPRESSED_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif')
+
+# Parsed citations of recent uploads, keyed by content hash, so /format and
+# /analyze reuse what /upload already parsed
+_CITATION_CACHE = OrderedDict()
+_CITATION_CACHE_SIZE = 32
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def extract_docx_structure(file_path):
-    """Extract content structure from DOCX with preserved paragraph and character styles"""
-    temp_dir = tempfile.mkdtemp()
-    try:
-        with zipfile.ZipFile(file_path, 'r') as zip_ref:
-            zip_ref.extractall(temp_dir)
-        
-        # Parse document.xml
-        doc_path = os.path.join(temp_dir, 'word', 'document.xml')
-        with open(doc_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-        
-        # Parse endnotes.xml if exists
-        endnotes_path = os.path.join(temp_dir, 'word', 'endnotes.xml')
-        endnotes_content = ""
-        if os.path.exists(endnotes_path):
-            with open(endnotes_path, 'r', encoding='utf-8') as f:
-                endnotes_content = f.read()
-        
-        # Parse styles.xml if exists  
-        styles_path = os.path.join(temp_dir, 'word', 'styles.xml')
-        styles_content = ""
-        if os.path.exists(styles_path):
-            with open(styles_path, 'r', encoding='utf-8') as f:
-                styles_content = f.read()
-        
-        return {
-            'document': content,
-            'endnotes': endnotes_content,
-            'styles': styles_content,
-            'temp_dir': temp_dir
-        }
-    except Exception as e:
-        shutil.rmtree(temp_dir, ignore_errors=True)
-        raise e
+def file_digest(stream):
+    """BLAKE2b hex digest of a binary stream's contents, rewinding it afterwards"""
+    digest = hashlib.blake2b(digest_size=16)
+    for chunk in iter(lambda: stream.read(65536), b''):
+        digest.update(chunk)
+    stream.seek(0)
+    return digest.hexdigest()
+
+def cache_citations(file_hash, citations):
+    """Remember parsed citations for a file, evicting the least recently used"""
+    _CITATION_CACHE[file_hash] = citations
+    _CITATION_CACHE.move_to_end(file_hash)
+    while len(_CITATION_CACHE) > _CITATION_CACHE_SIZE:
+        _CITATION_CACHE.popitem(last=False)
 
-def parse_citations(endnotes_xml):
-    """Parse citations from endnotes.xml"""
-    if not endnotes_xml:
-        return []
+def get_cached_citations(file_hash):
+    """Return previously parsed citations for a file, or None"""
+    citations = _CITATION_CACHE.get(file_hash)
+    if citations is not None:
+        _CITATION_CACHE.move_to_end(file_hash)
+    return citations
+
+def docx_part_info(zip_ref, name):
+    """Return the ZipInfo of a part of an open DOCX, or None if it is missing"""
+    try:
+        info = zip_ref.getinfo(name)
+    except KeyError:
+        return None
     
+    # Guard against parts that inflate far beyond any sane upload
+    if info.file_size > app.config['MAX_CONTENT_LENGTH']:
+        raise InvalidDocumentError(f'Document part {name} is too large')
+    
+    return info
+
+def w_namespace(elem):
+    """Return the '{uri}' prefix of an element's tag, e.g. for its w:id attribute"""
+    return '{%s}' % ET.QName(elem).namespace
+
+def endnote_text(note):
+    """Return the stripped citation text of a w:endnote element"""
+    # Only w:t nodes, in a single C-level walk; other text (field codes,
+    # deleted runs) is not citation text
+    return ''.join(note.itertext(w_namespace(note) + 't', with_tail=False)).strip()
+
+def parse_citations(file_path):
+    """Parse citations from a DOCX's endnotes.xml"""
+    with zipfile.ZipFile(file_path, 'r') as zip_ref:
+        if 'word/document.xml' not in zip_ref.namelist():
+            raise InvalidDocumentError('word/document.xml is missing')
+        
+        info = docx_part_info(zip_ref, 'word/endnotes.xml')
+        if info is None or info.file_size == 0:
+            return []
+        
+        with zip_ref.open(info) as source:
+            return parse_endnotes(source)
+
+def parse_endnotes(source):
+    """Parse citations from an endnotes.xml file object"""
     # Extract endnote text content
     endnotes = []
     
-    # Find all endnote entries
-    endnote_pattern = r'<w:endnote[^>]*w:id="(\d+)"[^>]*>(.*?)</w:endnote>'
-    matches = re.finditer(endnote_pattern, endnotes_xml, re.DOTALL)
-    
-    for match in matches:
-        note_id = match.group(1)
-        note_content = match.group(2)
+    # Stream endnote elements, discarding each one once its text is read
+    for _, elem in ET.iterparse(source, events=('end',), tag=W_ENDNOTE_TAGS, huge_tree=True):
+        note_id = elem.get(w_namespace(elem) + 'id')
         
         # Skip separator and continuation notes
-        if note_id in ['-1', '0']:
-            continue
-        
-        # Extract text from the note
-        text_pattern = r'<w:t[^>]*>([^<]+)</w:t>'
-        texts = re.findall(text_pattern, note_content)
-        full_text = ''.join(texts)
-        
-        if full_text.strip():
-            endnotes.append({
-                'id': note_id,
-                'text': full_text.strip(),
-                'original_xml': note_content
-            })
+        if note_id not in ('-1', '0'):
+            full_text = endnote_text(elem)
+            
+            if full_text:
+                endnotes.append({
+                    'id': note_id,
+                    'text': full_text
+                })
+        
+        # Free the note, and the already-cleared notes before it that the
+        # root still holds on to
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
     
     return endnotes
 
 def identify_citation_type(citation_text):
     """Identify the type and structure of a citation"""
+    # Callers annotate the result, so build a fresh dict from the cached tuple
+    cit_type, components, confidence = _identify_citation_type(citation_text)
+    return {
+        'type': cit_type,
+        'components': dict(components),
+        'confidence': confidence
+    }
+
+@lru_cache(maxsize=4096)
+def _identify_citation_type(citation_text):
+    # Cached results are shared between calls, so keep them immutable
+    result = _classify_citation(citation_text)
+    return result['type'], tuple(result['components'].items()), result['confidence']
+
+def _classify_citation(citation_text):
     result = {
         'type': 'unknown',
         'components': {},
         'confidence': 0
     }
     
-    # Book pattern (Author. Title. City: Publisher, Year)
-    book_pattern = r'^([^.]+)\.\s+([^.]+)\.\s+([^:]+):\s+([^,]+),\s+(\d{4})'
-    if re.match(book_pattern, citation_text):
-        match = re.match(book_pattern, citation_text)
+    # Book or journal article pattern, tried in a single regex pass; both
+    # shapes start with "Author." so text without a period can't match
+    match = _WORK_RE.match(citation_text) if '.' in citation_text else None
+    if match and match.lastgroup == 'book':
         result['type'] = 'book'
         result['components'] = {
-            'author': match.group(1),
-            'title': match.group(2),
-            'city': match.group(3),
-            'publisher': match.group(4),
-            'year': match.group(5)
+            'author': match.group('book_author'),
+            'title': match.group('book_title'),
+            'city': match.group('city'),
+            'publisher': match.group('publisher'),
+            'year': match.group('year')
         }
         result['confidence'] = 0.9
         return result
     
-    # Journal article pattern
-    journal_pattern = r'^([^.]+)\.\s+"([^"]+)"\s+([^,]+),?\s+(?:vol\.\s+)?(\d+)'
-    if re.search(journal_pattern, citation_text):
-        match = re.search(journal_pattern, citation_text)
+    if match:
         result['type'] = 'journal'
         result['components'] = {
-            'author': match.group(1),
-            'title': match.group(2),
-            'journal': match.group(3),
-            'volume': match.group(4)
+            'author': match.group('journal_author'),
+            'title': match.group('journal_title'),
+            'journal': match.group('journal_name'),
+            'volume': match.group('volume')
         }
         result['confidence'] = 0.85
         return result
@@ -151,15 +217,11 @@ def identify_citation_type(citation_text):
         result['confidence'] = 0.8
         
         # Try to extract URL
-        url_pattern = r'(https?://[^\s]+|www\.[^\s]+)'
-        url_match = re.search(url_pattern, citation_text)
-        if url_match:
+        if url_match := _URL_RE.search(citation_text):
             result['components']['url'] = url_match.group(1)
         
         # Try to extract access date
-        date_pattern = r'[Aa]ccessed\s+([^.]+)'
-        date_match = re.search(date_pattern, citation_text)
-        if date_match:
+        if date_match := _ACCESS_DATE_RE.search(citation_text):
             result['components']['access_date'] = date_match.group(1)
         
         return result
@@ -245,70 +307,59 @@ def apply_citation_style(citations, style='chicago'):
     
     return formatted_citations
 
-def create_formatted_docx(original_path, formatted_citations, output_path, docx_structure):
-    """Create new DOCX with formatted citations while preserving all styles"""
-    temp_output = tempfile.mkdtemp()
-    
-    try:
-        # Copy all files from original
-        shutil.copytree(docx_structure['temp_dir'], temp_output, dirs_exist_ok=True)
+def format_endnotes_xml(endnotes_xml, formatted_by_id):
+    """Return endnotes.xml bytes with the text of the given endnotes replaced"""
+    root = ET.fromstring(endnotes_xml, ET.XMLParser(huge_tree=True))
+    ns = w_namespace(root)
+    
+    for note in root.iterfind(ns + 'endnote'):
+        formatted_text = formatted_by_id.get(note.get(ns + 'id'))
+        if formatted_text is None:
+            continue
         
-        # Update endnotes.xml with formatted citations
-        endnotes_path = os.path.join(temp_output, 'word', 'endnotes.xml')
+        text_nodes = list(note.iter(ns + 't'))
+        if not text_nodes:
+            continue
         
-        if os.path.exists(endnotes_path) and formatted_citations:
-            with open(endnotes_path, 'r', encoding='utf-8') as f:
-                endnotes_content = f.read()
+        # For simplicity, put all text in the first text node and drop the others,
+        # leaving the surrounding runs and paragraph markup in place
+        text_nodes[0].text = formatted_text
+        for text_node in text_nodes[1:]:
+            text_node.getparent().remove(text_node)
+    
+    tree = root.getroottree()
+    return ET.tostring(tree, encoding='UTF-8', xml_declaration=True,
+                       standalone=tree.docinfo.standalone)
+
+def create_formatted_docx(original_path, formatted_citations, output_path):
+    """Create new DOCX with formatted citations while preserving all styles"""
+    # Notes the style left unchanged keep their original runs and formatting
+    changed_citations = [c for c in formatted_citations if c['formatted'] != c['original']]
+    
+    # No endnotes, or none the style changed: the original file is the result
+    if not changed_citations:
+        shutil.copyfile(original_path, output_path)
+        return True
+    
+    with zipfile.ZipFile(original_path, 'r') as zin, \
+            zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED,
+                            compresslevel=_DEFLATE_LEVEL) as zout:
+        # Copy every member of the original, rewriting only endnotes.xml
+        for info in zin.infolist():
+            data = zin.read(info)
             
-            # Replace each citation text while preserving XML structure
-            for citation in formatted_citations:
-                # Find the endnote by ID
-                pattern = f'<w:endnote[^>]*w:id="{citation["id"]}"[^>]*>(.*?)</w:endnote>'
-                match = re.search(pattern, endnotes_content, re.DOTALL)
-                
-                if match:
-                    note_xml = match.group(1)
-                    
-                    # Extract all text nodes
-                    text_pattern = r'(<w:t[^>]*>)([^<]+)(</w:t>)'
-                    text_matches = list(re.finditer(text_pattern, note_xml))
-                    
-                    if text_matches:
-                        # Replace text content while preserving structure
-                        formatted_text = citation['formatted']
-                        
-                        # For simplicity, replace all text in first text node
-                        first_match = text_matches[0]
-                        new_xml = note_xml[:first_match.start()] + \
-                                 first_match.group(1) + formatted_text + first_match.group(3)
-                        
-                        # Remove other text nodes if multiple
-                        for match in reversed(text_matches[1:]):
-                            new_xml = new_xml[:match.start()] + new_xml[match.end():]
-                        
-                        # Update the endnotes content
-                        full_note = f'<w:endnote w:id="{citation["id"]}">{new_xml}</w:endnote>'
-                        endnotes_content = endnotes_content.replace(match.group(0), full_note)
+            if info.filename == 'word/endnotes.xml':
+                # Replace each citation text in one pass over the parsed endnotes
+                data = format_endnotes_xml(
+                    data, {c['id']: c['formatted'] for c in changed_citations})
             
-            # Write updated endnotes
-            with open(endnotes_path, 'w', encoding='utf-8') as f:
-                f.write(endnotes_content)
-        
-        # Create the output DOCX
-        with zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for root, dirs, files in os.walk(temp_output):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    arcname = os.path.relpath(file_path, temp_output)
-                    zipf.write(file_path, arcname)
-        
-        return True
-        
-    finally:
-        # Cleanup
-        shutil.rmtree(temp_output, ignore_errors=True)
-        if docx_structure.get('temp_dir'):
-            shutil.rmtree(docx_structure['temp_dir'], ignore_errors=True)
+            if info.filename.lower().endswith(_PRECOMPRESSED_EXTENSIONS):
+                zout.writestr(info, data, compress_type=zipfile.ZIP_STORED)
+            else:
+                zout.writestr(info, data, compress_type=zipfile.ZIP_DEFLATED,
+                              compresslevel=_DEFLATE_LEVEL)
+    
+    return True
 
 @app.route('/')
 def index():
@@ -328,31 +379,23 @@ def upload_file():
         return jsonify({'error': 'Invalid file type. Only .docx files are allowed'}), 400
     
     # Save uploaded file
-    filename = secure_filename(file.filename)
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    filename = f"{timestamp}_{filename}"
+    filename = f"{time.time_ns()}_{secure_filename(file.filename)}"
     file_path = os.path.join(UPLOAD_FOLDER, filename)
+    file_hash = file_digest(file.stream)
     file.save(file_path)
     
     try:
-        # Extract DOCX structure
-        docx_structure = extract_docx_structure(file_path)
-        
-        # Parse citations
-        citations = parse_citations(docx_structure['endnotes'])
+        # Parse citations, unless the same file was parsed recently
+        citations = get_cached_citations(file_hash)
+        if citations is None:
+            citations = parse_citations(file_path)
+            cache_citations(file_hash, citations)
         
         # Store in session for later processing
         session['current_file'] = file_path
+        session['file_hash'] = file_hash
         session['original_filename'] = file.filename
-        session['docx_structure'] = {
-            'document': docx_structure['document'][:1000],  # Store sample for preview
-            'endnotes': docx_structure['endnotes'][:1000],
-            'has_endnotes': bool(citations)
-        }
-        
-        # Clean up temp directory
-        if docx_structure.get('temp_dir'):
-            shutil.rmtree(docx_structure['temp_dir'], ignore_errors=True)
+        session['has_endnotes'] = bool(citations)
         
         # Analyze citations
         citation_analysis = []
@@ -372,7 +415,11 @@ def upload_file():
             'preview': citation_analysis
         })
         
+    except _DOCUMENT_ERRORS as e:
+        app.logger.warning('Invalid document %s: %s', file_path, e)
+        return jsonify({'error': f'Invalid document structure: {e}'}), 400
     except Exception as e:
+        app.logger.exception('Upload of %s failed', file_path)
         return jsonify({'error': str(e)}), 500
 
 @app.route('/format', methods=['POST'])
@@ -387,11 +434,10 @@ def format_citations():
     file_path = session['current_file']
     
     try:
-        # Re-extract structure
-        docx_structure = extract_docx_structure(file_path)
-        
-        # Parse all citations
-        citations = parse_citations(docx_structure['endnotes'])
+        # Parse all citations, unless /upload already did
+        citations = get_cached_citations(session.get('file_hash'))
+        if citations is None:
+            citations = parse_citations(file_path)
         
         # Apply formatting
         formatted_citations = apply_citation_style(citations, style)
@@ -401,7 +447,7 @@ def format_citations():
         output_path = os.path.join(UPLOAD_FOLDER, output_filename)
         
         # Create formatted document
-        create_formatted_docx(file_path, formatted_citations, output_path, docx_structure)
+        create_formatted_docx(file_path, formatted_citations, output_path)
         
         # Store output path in session
         session['output_file'] = output_path
@@ -413,7 +459,11 @@ def format_citations():
             'download_ready': True
         })
         
+    except _DOCUMENT_ERRORS as e:
+        app.logger.warning('Invalid document %s: %s', file_path, e)
+        return jsonify({'error': f'Invalid document structure: {e}'}), 400
     except Exception as e:
+        app.logger.exception('Formatting %s failed', file_path)
         return jsonify({'error': str(e)}), 500
 
 @app.route('/download')
@@ -444,9 +494,10 @@ def analyze_citations():
     file_path = session['current_file']
     
     try:
-        # Extract and parse
-        docx_structure = extract_docx_structure(file_path)
-        citations = parse_citations(docx_structure['endnotes'])
+        # Extract and parse, unless /upload already did
+        citations = get_cached_citations(session.get('file_hash'))
+        if citations is None:
+            citations = parse_citations(file_path)
         
         # Analyze all citations
         analysis_results = {
@@ -484,13 +535,13 @@ def analyze_citations():
                 'components': analysis.get('components', {})
             })
         
-        # Clean up
-        if docx_structure.get('temp_dir'):
-            shutil.rmtree(docx_structure['temp_dir'], ignore_errors=True)
-        
         return jsonify(analysis_results)
         
+    except _DOCUMENT_ERRORS as e:
+        app.logger.warning('Invalid document %s: %s', file_path, e)
+        return jsonify({'error': f'Invalid document structure: {e}'}), 400
     except Exception as e:
+        app.logger.exception('Analysis of %s failed', file_path)
         return jsonify({'error': str(e)}), 500
 
 @app.route('/clear', methods=['POST'])
@@ -503,6 +554,8 @@ def clear_session():
     if 'output_file' in session and os.path.exists(session['output_file']):
         os.remove(session['output_file'])
     
+    _CITATION_CACHE.pop(session.get('file_hash'), None)
+    
     # Clear session
     session.clear()
     